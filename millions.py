@@ -4,11 +4,14 @@ from discord import app_commands
 from discord.ext import commands, tasks
 from datetime import datetime, timedelta
 import asyncio
+import functools
 import json
 from dotenv import load_dotenv
 import logging
 import sys
+import threading
 import time
+from contextlib import contextmanager
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,13 +27,58 @@ intents.members = True
 intents.guilds = True
 bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
 
+# Сколько секунд держать в памяти редко меняющиеся данные из БД
+CACHE_TTL = 30
+# Роли синхронизируются по событиям Gateway, периодический обход только страхует от пропусков
+MONITOR_INTERVAL = 60
+# Как часто проверять истёкшие баны; не зависит от обхода ролей
+UNBAN_INTERVAL = 30
+# Сколько истёкших банов снимать за один проход
+UNBAN_BATCH_SIZE = 50
+# На сколько откладывать бан, который не удалось снять из-за ошибки Discord
+UNBAN_RETRY_DELAY = timedelta(minutes=5)
+# Сколько участников сервера проверяет один тик мониторинга и сколько из них параллельно
+MONITOR_BATCH_SIZE = 15
+MONITOR_CONCURRENCY = 5
+# Сколько соединений с PostgreSQL держит пул (столько запросов может идти параллельно)
+DB_POOL_SIZE = 10
+# Срок временного бана
+BAN_DURATION = timedelta(seconds=600)
+# Сколько отслеживаемых ролей показывать на одной странице /list_roles
+ROLES_PER_PAGE = 15
+# Права для @everyone на созданных ботом каналах; объект только читается, поэтому общий
+HIDDEN_OVERWRITE = discord.PermissionOverwrite(view_channel=False)
+
 # ========== БАЗА ДАННЫХ ==========
+@functools.lru_cache(maxsize=None)
+def _sqlite_query(query):
+    # Запросы написаны с плейсхолдерами psycopg2, SQLite ожидает '?'
+    return query.replace('%s', '?')
+
 class Database:
     def __init__(self):
         self.conn = None
+        self.pool = None
         self.use_sqlite = False
+        # Соединение открытой в этом потоке транзакции
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        # Потоков у to_thread больше, чем соединений: лишние ждут свободное, а не получают PoolError
+        self._pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+        # guild.id -> строка servers; сервер из таблицы не удаляется, поэтому без срока жизни
+        self._servers_cache = {}
+        # guild.id -> (время загрузки, настройки)
+        self._settings_cache = {}
+        # Диалект определяется один раз при подключении: для PostgreSQL запрос не меняется
+        self._translate = str
+        # Ошибки соединения, после которых запрос имеет смысл повторить
+        self._retry_errors = ()
         self.connect()
     
+    @property
+    def connected(self):
+        return self.conn is not None or self.pool is not None
+    
     def connect(self):
         try:
             database_url = os.getenv('DATABASE_URL')
@@ -40,145 +88,373 @@ class Database:
             if database_url:
                 import psycopg2
                 from psycopg2.extras import RealDictCursor
-                self.conn = psycopg2.connect(database_url, sslmode='require', cursor_factory=RealDictCursor)
-                self.conn.autocommit = True
+                from psycopg2.pool import ThreadedConnectionPool
+                self._retry_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+                # Каждый поток из db_call берёт своё соединение, запросы к PostgreSQL идут параллельно
+                self.pool = ThreadedConnectionPool(1, DB_POOL_SIZE, database_url, sslmode='require', cursor_factory=RealDictCursor)
                 logger.info("✅ Подключено к PostgreSQL")
             else:
                 import sqlite3
                 self.use_sqlite = True
+                self._translate = _sqlite_query
+                self._retry_errors = (sqlite3.OperationalError,)
                 self.conn = sqlite3.connect('bot_database.db', check_same_thread=False)
                 self.conn.row_factory = sqlite3.Row
+                # WAL: чтение не ждёт запись, а fsync нужен только на контрольных точках
+                self.conn.execute('PRAGMA journal_mode=WAL')
+                self.conn.execute('PRAGMA synchronous=NORMAL')
+                self.conn.execute('PRAGMA cache_size=-65536')
+                self.conn.execute('PRAGMA busy_timeout=5000')
+                self.conn.execute('PRAGMA mmap_size=268435456')
+                self.conn.execute('PRAGMA temp_store=MEMORY')
                 logger.info("✅ Создана SQLite база")
-        except:
+        except Exception as e:
+            logger.error(f"❌ Ошибка подключения к БД: {e}")
             self.conn = None
+            self.pool = None
+    
+    @contextmanager
+    def _connection(self):
+        """Выдаёт соединение для запроса: транзакции, пула или общее соединение SQLite"""
+        tx_conn = getattr(self._local, 'conn', None)
+        if tx_conn is not None:
+            yield tx_conn
+        elif self.pool:
+            with self._pool_slots:
+                conn = self.pool.getconn()
+                conn.autocommit = True
+                try:
+                    yield conn
+                finally:
+                    # Оборванное соединение в пул не возвращаем
+                    self.pool.putconn(conn, close=bool(conn.closed))
+        else:
+            # Соединение SQLite одно на все потоки, поэтому запросы выполняются по очереди
+            with self._lock:
+                yield self.conn
     
     def execute(self, query, params=None, fetchone=False, fetchall=False):
-        if not self.conn:
+        if not self.connected:
             return None
         
+        in_tx = getattr(self._local, 'conn', None) is not None
         for attempt in range(2):
             try:
-                cursor = self.conn.cursor()
-                if self.use_sqlite:
-                    query = query.replace('%s', '?')
-                cursor.execute(query, params or ())
-                
-                if fetchone:
-                    result = cursor.fetchone()
-                elif fetchall:
-                    result = cursor.fetchall()
-                else:
-                    result = cursor.rowcount
-                
-                if self.use_sqlite:
-                    self.conn.commit()
-                cursor.close()
-                return result
+                with self._connection() as conn:
+                    cursor = conn.cursor()
+                    try:
+                        cursor.execute(self._translate(query), params or ())
+                        
+                        if fetchone:
+                            result = cursor.fetchone()
+                        elif fetchall:
+                            result = cursor.fetchall()
+                        else:
+                            result = cursor.rowcount
+                        
+                        if self.use_sqlite and not in_tx:
+                            conn.commit()
+                        return result
+                    finally:
+                        cursor.close()
             except Exception as e:
-                try:
-                    cursor.close()
-                except:
-                    pass
-                if attempt == 1:
+                # Повторяем только сбои соединения; ошибка в самом запросе повторится и во второй раз.
+                # Ждать перед повтором не нужно: оборванное соединение пул уже закрыл и выдаст новое,
+                # а занятую SQLite дожидается busy_timeout
+                if attempt == 1 or in_tx or not isinstance(e, self._retry_errors):
                     logger.error(f"❌ SQL ошибка: {e}")
-                time.sleep(0.5)
+                    # Внутри транзакции ошибку пробрасываем, чтобы transaction() сделал ROLLBACK
+                    if in_tx:
+                        raise
+                    return None
         return None
     
+    @contextmanager
+    def transaction(self):
+        """Объединяет несколько запросов в одну транзакцию с одним commit"""
+        if not self.connected:
+            yield None
+            return
+        
+        # Вложенный вызов в том же потоке просто продолжает текущую транзакцию
+        tx_conn = getattr(self._local, 'conn', None)
+        if tx_conn is not None:
+            yield tx_conn
+            return
+        
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            self._local.conn = conn
+            try:
+                cursor.execute('BEGIN')
+                yield conn
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            finally:
+                self._local.conn = None
+                cursor.close()
+    
     def create_tables(self):
-        if not self.conn:
+        if not self.connected:
             return
         
-        tables = [
-            '''CREATE TABLE IF NOT EXISTS servers (id SERIAL PRIMARY KEY, discord_id VARCHAR(255) NOT NULL, name VARCHAR(255) NOT NULL)''',
-            '''CREATE TABLE IF NOT EXISTS server_settings (id SERIAL PRIMARY KEY, server_id INTEGER NOT NULL, news_channel_id VARCHAR(255), flood_channel_id VARCHAR(255), tags_channel_id VARCHAR(255), media_channel_id VARCHAR(255), logs_channel_id VARCHAR(255), voice_channel_ids TEXT)''',
-            '''CREATE TABLE IF NOT EXISTS tracked_roles (id SERIAL PRIMARY KEY, server_id INTEGER NOT NULL, source_server_id VARCHAR(255) NOT NULL, source_role_id VARCHAR(255) NOT NULL, target_role_id VARCHAR(255), is_active BOOLEAN DEFAULT TRUE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
-            '''CREATE TABLE IF NOT EXISTS banned_users (id SERIAL PRIMARY KEY, server_id INTEGER NOT NULL, user_id VARCHAR(255) NOT NULL, username VARCHAR(255) NOT NULL, unban_time TIMESTAMP, is_unbanned BOOLEAN DEFAULT FALSE)'''
+        self._migrate_legacy_schema()
+        # Вся схема уходит одним пакетом, а не отдельным запросом на каждую таблицу и индекс
+        script = ';\n'.join(self._schema())
+        try:
+            with self._connection() as conn:
+                if self.use_sqlite:
+                    conn.executescript(script)
+                else:
+                    cursor = conn.cursor()
+                    cursor.execute(script)
+                    cursor.close()
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания таблиц: {e}")
+    
+    def _schema(self):
+        # Discord ID храним как BIGINT, сервер идентифицируется своим snowflake
+        id_column = 'INTEGER PRIMARY KEY AUTOINCREMENT' if self.use_sqlite else 'SERIAL PRIMARY KEY'
+        return [
+            '''CREATE TABLE IF NOT EXISTS servers (discord_id BIGINT PRIMARY KEY, name VARCHAR(255) NOT NULL)''',
+            '''CREATE TABLE IF NOT EXISTS server_settings (server_id BIGINT PRIMARY KEY, news_channel_id BIGINT, flood_channel_id BIGINT, tags_channel_id BIGINT, media_channel_id BIGINT, logs_channel_id BIGINT)''',
+            '''CREATE TABLE IF NOT EXISTS server_voice_channels (server_id BIGINT NOT NULL, channel_id BIGINT NOT NULL, PRIMARY KEY (server_id, channel_id))''',
+            '''CREATE INDEX IF NOT EXISTS idx_server_voice_channels_channel ON server_voice_channels (channel_id)''',
+            f'''CREATE TABLE IF NOT EXISTS tracked_roles (id {id_column}, server_id BIGINT NOT NULL, source_server_id BIGINT NOT NULL, source_role_id BIGINT NOT NULL, target_role_id BIGINT, is_active BOOLEAN DEFAULT TRUE, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+            # Активное отслеживание одной роли-источника на сервере может быть только одно;
+            # индекс заодно обслуживает выборки по server_id
+            '''CREATE UNIQUE INDEX IF NOT EXISTS idx_tracked_roles_active_source ON tracked_roles (server_id, source_server_id, source_role_id) WHERE is_active = TRUE''',
+            '''CREATE INDEX IF NOT EXISTS idx_tracked_roles_active_target ON tracked_roles (target_role_id) WHERE is_active = TRUE''',
+            '''CREATE TABLE IF NOT EXISTS banned_users (server_id BIGINT NOT NULL, user_id BIGINT NOT NULL, username VARCHAR(255) NOT NULL, unban_time TIMESTAMP, is_unbanned BOOLEAN DEFAULT FALSE, PRIMARY KEY (server_id, user_id))''',
+            # Авторазбан ищет только активные баны по времени, частичный индекс покрывает именно их
+            '''CREATE INDEX IF NOT EXISTS idx_banned_users_pending ON banned_users (unban_time) WHERE is_unbanned = FALSE'''
         ]
+    
+    def _migrate_legacy_schema(self):
+        """Переносит данные из старой схемы (VARCHAR ID + servers.id) в BIGINT-схему"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('SELECT * FROM servers LIMIT 0')
+                legacy = 'id' in [column[0] for column in cursor.description]
+            except Exception:
+                legacy = False
+            finally:
+                cursor.close()
+        
+        if not legacy:
+            return
+        
+        tables = ['servers', 'server_settings', 'tracked_roles', 'banned_users']
+        try:
+            with self.transaction() as conn:
+                cursor = conn.cursor()
+                for table in tables:
+                    cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+                for table in self._schema():
+                    cursor.execute(table)
+                
+                cursor.execute('''INSERT INTO servers (discord_id, name)
+                                  SELECT CAST(discord_id AS BIGINT), MAX(name) FROM servers_legacy GROUP BY discord_id''')
+                # В старой схеме уникальности не было: из дублей оставляем самую новую строку (с наибольшим id).
+                # WHERE TRUE нужен SQLite, чтобы ON CONFLICT не разбирался как условие JOIN
+                cursor.execute('''INSERT INTO server_settings (server_id, news_channel_id, flood_channel_id, tags_channel_id, media_channel_id, logs_channel_id)
+                                  SELECT CAST(s.discord_id AS BIGINT), CAST(ss.news_channel_id AS BIGINT), CAST(ss.flood_channel_id AS BIGINT), CAST(ss.tags_channel_id AS BIGINT),
+                                         CAST(ss.media_channel_id AS BIGINT), CAST(ss.logs_channel_id AS BIGINT)
+                                  FROM server_settings_legacy ss JOIN servers_legacy s ON s.id = ss.server_id WHERE TRUE ORDER BY ss.id DESC
+                                  ON CONFLICT (server_id) DO NOTHING''')
+                cursor.execute('''SELECT CAST(s.discord_id AS BIGINT) AS server_id, ss.voice_channel_ids
+                                  FROM server_settings_legacy ss JOIN servers_legacy s ON s.id = ss.server_id ORDER BY ss.id DESC''')
+                voice_ids = {}
+                for row in cursor.fetchall():
+                    voice_ids.setdefault(row['server_id'], row['voice_channel_ids'])
+                voice_rows = list({(server_id, int(cid)) for server_id, ids in voice_ids.items() for cid in json.loads(ids or '[]')})
+                if voice_rows:
+                    placeholder = '?' if self.use_sqlite else '%s'
+                    cursor.executemany(f'INSERT INTO server_voice_channels (server_id, channel_id) VALUES ({placeholder}, {placeholder})', voice_rows)
+                cursor.execute('''INSERT INTO tracked_roles (id, server_id, source_server_id, source_role_id, target_role_id, is_active, created_at)
+                                  SELECT tr.id, CAST(s.discord_id AS BIGINT), CAST(tr.source_server_id AS BIGINT), CAST(tr.source_role_id AS BIGINT),
+                                         CAST(tr.target_role_id AS BIGINT), tr.is_active, tr.created_at
+                                  FROM tracked_roles_legacy tr JOIN servers_legacy s ON s.id = tr.server_id WHERE TRUE ORDER BY tr.id DESC
+                                  ON CONFLICT (server_id, source_server_id, source_role_id) WHERE is_active = TRUE DO NOTHING''')
+                cursor.execute('''INSERT INTO banned_users (server_id, user_id, username, unban_time, is_unbanned)
+                                  SELECT CAST(s.discord_id AS BIGINT), CAST(b.user_id AS BIGINT), b.username, b.unban_time, b.is_unbanned
+                                  FROM banned_users_legacy b JOIN servers_legacy s ON s.id = b.server_id WHERE TRUE ORDER BY b.id DESC
+                                  ON CONFLICT (server_id, user_id) DO NOTHING''')
+                if not self.use_sqlite:
+                    cursor.execute("SELECT setval(pg_get_serial_sequence('tracked_roles', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM tracked_roles")
+                
+                for table in tables:
+                    cursor.execute(f'DROP TABLE {table}_legacy')
+                cursor.close()
+            logger.info("✅ Схема БД обновлена")
+        except Exception as e:
+            # Транзакция откатилась и старые таблицы остались; на них ни один upsert не сработает
+            logger.error(f"❌ Ошибка миграции БД: {e}")
+            sys.exit(1)
+    
+    def _cache_get(self, cache: dict, key):
+        entry = cache.get(key)
+        if entry and time.monotonic() - entry[0] < CACHE_TTL:
+            return entry[1]
+        return None
+    
+    def get_or_create_server(self, discord_id: int, name: str):
+        cached = self._servers_cache.get(discord_id)
+        if cached:
+            return cached
+        
+        # Один запрос и для нового, и для существующего сервера; заодно обновляется название
+        result = self.execute('INSERT INTO servers (discord_id, name) VALUES (%s, %s) ON CONFLICT (discord_id) DO UPDATE SET name = EXCLUDED.name RETURNING *',
+                              (discord_id, name), fetchone=True)
+        if not result:
+            return None
         
-        for table in tables:
-            self.execute(table)
+        server = dict(result)
+        self._servers_cache[discord_id] = server
+        return server
+    
+    def forget_server(self, discord_id: int):
+        """Убирает сервер из кэшей; строки в БД остаются на случай возвращения бота"""
+        self._servers_cache.pop(discord_id, None)
+        self._settings_cache.pop(discord_id, None)
     
-    def get_or_create_server(self, discord_id: str, name: str):
-        result = self.execute('SELECT * FROM servers WHERE discord_id = %s', (discord_id,), fetchone=True)
-        if result:
-            return dict(result)
+    def preload_servers(self, discord_ids):
+        """Заполняет кэш серверов одним запросом, например для всех гильдий при запуске"""
+        if not discord_ids:
+            return
         
-        self.execute('INSERT INTO servers (discord_id, name) VALUES (%s, %s)', (discord_id, name))
-        return self.execute('SELECT * FROM servers WHERE discord_id = %s', (discord_id,), fetchone=True)
+        placeholders = ', '.join(['%s'] * len(discord_ids))
+        results = self.execute(f'SELECT * FROM servers WHERE discord_id IN ({placeholders})', list(discord_ids), fetchall=True)
+        for result in results or []:
+            self._servers_cache[result['discord_id']] = dict(result)
     
     def save_settings(self, server_id: int, settings: dict):
-        voice_ids = json.dumps(settings.get('voice_channel_ids', []))
+        voice_ids = settings.get('voice_channel_ids', [])
         
-        if self.use_sqlite:
-            self.execute('''INSERT OR REPLACE INTO server_settings (server_id, news_channel_id, flood_channel_id, tags_channel_id, media_channel_id, logs_channel_id, voice_channel_ids) VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                        (server_id, settings.get('news_channel_id'), settings.get('flood_channel_id'), settings.get('tags_channel_id'), settings.get('media_channel_id'), settings.get('logs_channel_id'), voice_ids))
-        else:
-            self.execute('''INSERT INTO server_settings (server_id, news_channel_id, flood_channel_id, tags_channel_id, media_channel_id, logs_channel_id, voice_channel_ids) VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT (server_id) DO UPDATE SET news_channel_id=EXCLUDED.news_channel_id, flood_channel_id=EXCLUDED.flood_channel_id, tags_channel_id=EXCLUDED.tags_channel_id, media_channel_id=EXCLUDED.media_channel_id, logs_channel_id=EXCLUDED.logs_channel_id, voice_channel_ids=EXCLUDED.voice_channel_ids''',
-                        (server_id, settings.get('news_channel_id'), settings.get('flood_channel_id'), settings.get('tags_channel_id'), settings.get('media_channel_id'), settings.get('logs_channel_id'), voice_ids))
+        with self.transaction():
+            self.execute('''INSERT INTO server_settings (server_id, news_channel_id, flood_channel_id, tags_channel_id, media_channel_id, logs_channel_id) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (server_id) DO UPDATE SET news_channel_id=EXCLUDED.news_channel_id, flood_channel_id=EXCLUDED.flood_channel_id, tags_channel_id=EXCLUDED.tags_channel_id, media_channel_id=EXCLUDED.media_channel_id, logs_channel_id=EXCLUDED.logs_channel_id''',
+                        (server_id, settings.get('news_channel_id'), settings.get('flood_channel_id'), settings.get('tags_channel_id'), settings.get('media_channel_id'), settings.get('logs_channel_id')))
+            
+            # Голосовые каналы хранятся отдельными строками, вставляем их одним запросом
+            self.execute('DELETE FROM server_voice_channels WHERE server_id = %s', (server_id,))
+            if voice_ids:
+                values = ', '.join(['(%s, %s)'] * len(voice_ids))
+                self.execute(f'INSERT INTO server_voice_channels (server_id, channel_id) VALUES {values}',
+                            [param for channel_id in voice_ids for param in (server_id, channel_id)])
+        self._settings_cache.pop(server_id, None)
     
     def get_settings(self, server_id: int):
-        result = self.execute('SELECT * FROM server_settings WHERE server_id = %s', (server_id,), fetchone=True)
-        return dict(result) if result else {}
-    
-    def add_tracked_role(self, server_id: int, source_server_id: str, source_role_id: str):
-        result = self.execute('SELECT id FROM tracked_roles WHERE server_id = %s AND source_server_id = %s AND source_role_id = %s AND is_active = TRUE',
-                            (server_id, source_server_id, source_role_id), fetchone=True)
-        if result:
-            return result['id']
-        
-        self.execute('INSERT INTO tracked_roles (server_id, source_server_id, source_role_id) VALUES (%s, %s, %s)',
-                    (server_id, source_server_id, source_role_id))
-        result = self.execute('SELECT id FROM tracked_roles WHERE server_id = %s AND source_server_id = %s AND source_role_id = %s',
-                            (server_id, source_server_id, source_role_id), fetchone=True)
-        return result['id'] if result else None
+        cached = self._cache_get(self._settings_cache, server_id)
+        if cached is not None:
+            return cached
+        
+        # Настройки и голосовые каналы забираем одним запросом
+        results = self.execute('''SELECT ss.*, vc.channel_id AS voice_channel_id FROM server_settings ss
+                                  LEFT JOIN server_voice_channels vc ON vc.server_id = ss.server_id
+                                  WHERE ss.server_id = %s''', (server_id,), fetchall=True)
+        settings = {}
+        if results:
+            settings = dict(results[0])
+            del settings['voice_channel_id']
+            settings['voice_channel_ids'] = [r['voice_channel_id'] for r in results if r['voice_channel_id'] is not None]
+        
+        self._settings_cache[server_id] = (time.monotonic(), settings)
+        return settings
     
-    def update_target_role(self, tracked_id: int, target_role_id: str):
-        self.execute('UPDATE tracked_roles SET target_role_id = %s WHERE id = %s', (target_role_id, tracked_id))
+    def add_tracked_role(self, server_id: int, source_server_id: int, source_role_id: int, target_role_id: int = None):
+        # Вставка или уже активное отслеживание за один запрос; без target_role_id прежняя целевая роль сохраняется
+        result = self.execute('''INSERT INTO tracked_roles (server_id, source_server_id, source_role_id, target_role_id) VALUES (%s, %s, %s, %s)
+                                 ON CONFLICT (server_id, source_server_id, source_role_id) WHERE is_active = TRUE
+                                 DO UPDATE SET target_role_id = COALESCE(EXCLUDED.target_role_id, tracked_roles.target_role_id) RETURNING id''',
+                              (server_id, source_server_id, source_role_id, target_role_id), fetchone=True)
+        return result['id'] if result else None
     
     def get_tracked_roles(self, server_id: int):
         results = self.execute('SELECT * FROM tracked_roles WHERE server_id = %s AND is_active = TRUE ORDER BY created_at DESC', (server_id,), fetchall=True)
-        return [dict(r) for r in results] if results else []
+        return results or []
+    
+    def get_tracked_roles_for_source(self, server_id: int, source_server_id: int):
+        results = self.execute('SELECT * FROM tracked_roles WHERE server_id = %s AND source_server_id = %s AND is_active = TRUE ORDER BY created_at DESC',
+                              (server_id, source_server_id), fetchall=True)
+        return results or []
+    
+    def get_all_tracked_roles(self):
+        results = self.execute('SELECT * FROM tracked_roles WHERE is_active = TRUE ORDER BY created_at DESC', fetchall=True)
+        return results or []
     
-    def deactivate_tracked_role(self, role_id: int):
-        self.execute('UPDATE tracked_roles SET is_active = FALSE WHERE id = %s', (role_id,))
+    def deactivate_tracked_role(self, role_id: int, target_role_id: int = None):
+        """Отключает отслеживание и возвращает, в скольких отслеживаниях осталась целевая роль"""
+        with self.transaction():
+            self.execute('UPDATE tracked_roles SET is_active = FALSE WHERE id = %s', (role_id,))
+            return self.count_target_role_usage(target_role_id) if target_role_id else 0
     
-    def get_tracked_role_by_id(self, role_id: int):
-        result = self.execute('SELECT * FROM tracked_roles WHERE id = %s', (role_id,), fetchone=True)
-        return dict(result) if result else None
+    def get_tracked_role_with_usage(self, role_id: int):
+        """Строка отслеживания вместе с числом активных отслеживаний той же целевой роли"""
+        return self.execute('''SELECT tr.*, (SELECT COUNT(*) FROM tracked_roles u WHERE u.target_role_id = tr.target_role_id AND u.is_active = TRUE) AS usage_count
+                               FROM tracked_roles tr WHERE tr.id = %s''', (role_id,), fetchone=True)
     
-    def get_tracked_role_by_source_id(self, server_id: int, source_role_id: str):
+    def get_tracked_role_by_source_id(self, server_id: int, source_role_id: int):
         result = self.execute('SELECT * FROM tracked_roles WHERE server_id = %s AND source_role_id = %s AND is_active = TRUE', 
                              (server_id, source_role_id), fetchone=True)
-        return dict(result) if result else None
+        return result
     
-    def count_target_role_usage(self, target_role_id: str):
+    def count_target_role_usage(self, target_role_id: int):
         result = self.execute('SELECT COUNT(*) as count FROM tracked_roles WHERE target_role_id = %s AND is_active = TRUE', 
                              (target_role_id,), fetchone=True)
         return result['count'] if result else 0
     
-    def ban_user(self, server_id: int, user_id: str, username: str):
-        unban = datetime.now() + timedelta(seconds=600)
-        if self.use_sqlite:
-            self.execute('INSERT OR REPLACE INTO banned_users (server_id, user_id, username, unban_time) VALUES (?, ?, ?, ?)',
-                        (server_id, user_id, username, unban.isoformat()))
-        else:
-            self.execute('INSERT INTO banned_users (server_id, user_id, username, unban_time) VALUES (%s, %s, %s, %s) ON CONFLICT (server_id, user_id) DO UPDATE SET unban_time=EXCLUDED.unban_time, is_unbanned=FALSE',
-                        (server_id, user_id, username, unban.isoformat()))
+    def ban_user(self, server_id: int, user_id: int, username: str):
+        unban = datetime.now() + BAN_DURATION
+        self.execute('INSERT INTO banned_users (server_id, user_id, username, unban_time) VALUES (%s, %s, %s, %s) ON CONFLICT (server_id, user_id) DO UPDATE SET username=EXCLUDED.username, unban_time=EXCLUDED.unban_time, is_unbanned=FALSE',
+                    (server_id, user_id, username, unban.isoformat()))
     
-    def unban_user(self, server_id: int, user_id: str):
+    def unban_user(self, server_id: int, user_id: int):
         self.execute('UPDATE banned_users SET is_unbanned = TRUE WHERE server_id = %s AND user_id = %s', (server_id, user_id))
     
-    def get_banned_users(self, server_id: int):
-        results = self.execute('SELECT * FROM banned_users WHERE server_id = %s AND is_unbanned = FALSE', (server_id,), fetchall=True)
-        return [dict(r) for r in results] if results else []
+    def unban_users(self, pairs):
+        """Снимает отметку бана сразу с нескольких пар (server_id, user_id)"""
+        values = ', '.join(['(%s, %s)'] * len(pairs))
+        self.execute(f'UPDATE banned_users SET is_unbanned = TRUE WHERE (server_id, user_id) IN (VALUES {values})',
+                    [param for pair in pairs for param in pair])
+    
+    def postpone_unbans(self, pairs):
+        """Переносит разбан нескольких пар (server_id, user_id), чтобы они не занимали начало очереди"""
+        values = ', '.join(['(%s, %s)'] * len(pairs))
+        retry_time = datetime.now() + UNBAN_RETRY_DELAY
+        self.execute(f'UPDATE banned_users SET unban_time = %s WHERE (server_id, user_id) IN (VALUES {values})',
+                    [retry_time.isoformat()] + [param for pair in pairs for param in pair])
+    
+    def count_banned_users(self, server_id: int):
+        result = self.execute('SELECT COUNT(*) as count FROM banned_users WHERE server_id = %s AND is_unbanned = FALSE', 
+                             (server_id,), fetchone=True)
+        return result['count'] if result else 0
     
     def get_users_to_unban(self):
-        results = self.execute('SELECT * FROM banned_users WHERE is_unbanned = FALSE AND unban_time <= %s', (datetime.now().isoformat(),), fetchall=True)
-        return [dict(r) for r in results] if results else []
+        results = self.execute('SELECT * FROM banned_users WHERE is_unbanned = FALSE AND unban_time <= %s ORDER BY unban_time LIMIT %s',
+                              (datetime.now().isoformat(), UNBAN_BATCH_SIZE), fetchall=True)
+        return results or []
 
 db = Database()
 db.create_tables()
 
+async def db_call(func, *args, **kwargs):
+    """Выполняет синхронный метод БД в отдельном потоке, не блокируя event loop"""
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+async def with_retry(coro_fn, *args, tries=3, **kwargs):
+    """Повторяет запрос к Discord при 429, выжидая Retry-After"""
+    for attempt in range(tries):
+        try:
+            return await coro_fn(*args, **kwargs)
+        except discord.HTTPException as e:
+            if e.status != 429 or attempt == tries - 1:
+                raise
+            retry_after = e.response.headers.get('Retry-After') if e.response is not None else None
+            await asyncio.sleep(float(retry_after) if retry_after else 2 ** attempt)
+
 # ========== МОДАЛЬНЫЕ ОКНА ==========
 class AddRoleModal(discord.ui.Modal, title="Добавить отслеживаемую роль"):
     server_id = discord.ui.TextInput(label="ID сервера-источника", placeholder="Введите ID сервера...", required=True, max_length=20)
@@ -186,7 +462,6 @@ class AddRoleModal(discord.ui.Modal, title="Добавить отслежива
     
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.send_message("🔄 Обрабатываю...", ephemeral=True)
-        await asyncio.sleep(0.5)
         await add_role(interaction, self.server_id.value, self.role_id.value)
 
 class UnbanModal(discord.ui.Modal, title="Разблокировать пользователя"):
@@ -224,18 +499,14 @@ class RoleSelectView(discord.ui.View):
         
         for role in tracked_roles:
             # Получаем информацию о роли
-            source_guild = bot.get_guild(int(role['source_server_id']))
+            source_guild = bot.get_guild(role['source_server_id'])
             source_role = None
             if source_guild:
-                source_role = source_guild.get_role(int(role['source_role_id']))
+                source_role = source_guild.get_role(role['source_role_id'])
             
-            target_role = None
-            if role['target_role_id']:
-                # Найдем гильдию для целевой роли
-                for guild in bot.guilds:
-                    target_role = guild.get_role(int(role['target_role_id']))
-                    if target_role:
-                        break
+            # Целевая роль всегда создаётся на сервере, которому принадлежит отслеживание
+            target_guild = bot.get_guild(role['server_id'])
+            target_role = target_guild.get_role(role['target_role_id']) if target_guild and role['target_role_id'] else None
             
             # Формируем текст для опции
             source_name = source_role.name if source_role else f"ID: {role['source_role_id']}"
@@ -257,15 +528,17 @@ class RoleSelectView(discord.ui.View):
         await confirm_remove_role(interaction, role_id)
 
 class ConfirmRemoveView(discord.ui.View):
-    def __init__(self, role_id, role_info):
+    def __init__(self, role_id, role_info, target_role=None):
         super().__init__(timeout=180)
         self.role_id = role_id
         self.role_info = role_info
+        self.target_role = target_role
     
     @discord.ui.button(label="✅ Да, удалить", style=discord.ButtonStyle.danger, row=0)
     async def confirm_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.defer(ephemeral=True)
-        await execute_remove_role(interaction, self.role_id, self.role_info)
+        # Нажатие подтверждаем до запросов к БД: на первый ответ у Discord только 3 секунды
+        await interaction.response.defer()
+        await execute_remove_role(interaction, self.role_id, self.role_info, self.target_role)
     
     @discord.ui.button(label="❌ Нет, отмена", style=discord.ButtonStyle.secondary, row=0)
     async def cancel_button(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -276,6 +549,13 @@ class ControlPanelView(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=None)
     
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # Панель публичная и переживает перезапуск, поэтому права проверяем на каждое нажатие, как у /souz
+        if isinstance(interaction.user, discord.Member) and interaction.user.guild_permissions.administrator:
+            return True
+        await interaction.response.send_message("❌ Панель доступна только администраторам", ephemeral=True)
+        return False
+    
     @discord.ui.button(label="⚙️ Настройка сервера", style=discord.ButtonStyle.primary, custom_id="setup_btn", row=0)
     async def setup_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer(ephemeral=True)
@@ -321,85 +601,218 @@ class ControlPanelView(discord.ui.View):
 class RoleMonitor:
     def __init__(self, bot):
         self.bot = bot
+        # guild.id -> с какого участника начинать следующий тик
+        self._monitor_offsets = {}
+        # guild.id -> (время загрузки, отслеживаемые роли)
+        self._tracked_cache = {}
+        # (время загрузки, обратный индекс источников), см. get_source_index
+        self._source_index = None
+    
+    async def get_tracked_roles(self, guild_id: int):
+        """Отслеживаемые роли сервера из кэша; БД запрашивается раз в CACHE_TTL"""
+        entry = self._tracked_cache.get(guild_id)
+        if entry and time.monotonic() - entry[0] < CACHE_TTL:
+            return entry[1]
+        
+        tracked_roles = await db_call(db.get_tracked_roles, guild_id)
+        self._tracked_cache[guild_id] = (time.monotonic(), tracked_roles)
+        return tracked_roles
+    
+    def invalidate_tracked_roles(self, guild_id: int):
+        self._tracked_cache.pop(guild_id, None)
+        self._source_index = None
+    
+    async def get_source_index(self):
+        """source_server_id -> {ID целевого сервера: ID отслеживаемых ролей-источников}"""
+        if self._source_index and time.monotonic() - self._source_index[0] < CACHE_TTL:
+            return self._source_index[1]
+        return await self.refresh_tracked_roles()
+    
+    async def refresh_tracked_roles(self):
+        """Загружает отслеживаемые роли всех серверов одним запросом и обновляет оба кэша"""
+        tracked_by_guild = {guild.id: [] for guild in self.bot.guilds}
+        index = {}
+        for tracked in await db_call(db.get_all_tracked_roles):
+            tracked_by_guild.setdefault(tracked['server_id'], []).append(tracked)
+            index.setdefault(tracked['source_server_id'], {}).setdefault(tracked['server_id'], set()).add(tracked['source_role_id'])
+        
+        now = time.monotonic()
+        for guild_id, tracked_roles in tracked_by_guild.items():
+            self._tracked_cache[guild_id] = (now, tracked_roles)
+        self._source_index = (now, index)
+        return index
     
-    async def sync_user_roles(self, guild: discord.Guild, user_id: int):
+    def build_sources(self, guild: discord.Guild, tracked_roles):
+        """Группирует отслеживаемые роли по серверу-источнику и заранее находит гильдии и роли.
+        
+        Возвращает список (целевая роль, сервер-источник, ID ролей-источников).
+        """
+        servers_roles = {}
+        for tracked in tracked_roles:
+            servers_roles.setdefault(tracked['source_server_id'], []).append(tracked)
+        
+        sources = []
+        for server_id, roles_list in servers_roles.items():
+            if not roles_list[0]['target_role_id']:
+                continue
+            
+            target_role = guild.get_role(roles_list[0]['target_role_id'])
+            if not target_role:
+                continue
+            
+            source_role_ids = {tracked['source_role_id'] for tracked in roles_list}
+            sources.append((target_role, self.bot.get_guild(server_id), source_role_ids))
+        return sources
+    
+    async def sync_user_roles(self, guild: discord.Guild, user_id: int, sources=None):
         try:
             user = guild.get_member(user_id)
-            if not user or not db.conn:
+            if not user or not db.connected:
                 return False
             
-            server_data = db.get_or_create_server(str(guild.id), guild.name)
-            if not server_data:
-                return False
+            if sources is None:
+                sources = self.build_sources(guild, await self.get_tracked_roles(guild.id))
             
-            tracked_roles = db.get_tracked_roles(server_data['id'])
+            # Целевая роль нужна, если хотя бы на одном сервере-источнике есть нужная роль
+            wanted = {}
+            for target_role, source_guild, source_role_ids in sources:
+                source_member = source_guild.get_member(user_id) if source_guild else None
+                # get_role ищет по отсортированным ID ролей участника, список Role не собирается
+                has_role = source_member is not None and any(source_member.get_role(role_id) for role_id in source_role_ids)
+                wanted[target_role] = wanted.get(target_role, False) or has_role
             
-            servers_roles = {}
-            for tracked in tracked_roles:
-                server_id = tracked['source_server_id']
-                if server_id not in servers_roles:
-                    servers_roles[server_id] = []
-                servers_roles[server_id].append(tracked)
+            # Обычно всё уже совпадает, и набор ролей участника строить не нужно
+            changes = [(role, has_role) for role, has_role in wanted.items() if has_role != (user.get_role(role.id) is not None)]
+            if not changes:
+                return True
             
-            for server_id, roles_list in servers_roles.items():
-                if not roles_list or not roles_list[0]['target_role_id']:
-                    continue
-                
-                target_role = guild.get_role(int(roles_list[0]['target_role_id']))
-                if not target_role:
-                    continue
-                
-                has_role = False
-                for tracked in roles_list:
-                    source_guild = self.bot.get_guild(int(tracked['source_server_id']))
-                    if not source_guild:
-                        continue
-                    
-                    source_member = source_guild.get_member(user_id)
-                    if source_member:
-                        source_role = source_guild.get_role(int(tracked['source_role_id']))
-                        if source_role and source_role in source_member.roles:
-                            has_role = True
-                            break
-                
-                if has_role and target_role not in user.roles:
-                    await user.add_roles(target_role, reason="Синхронизация")
-                elif not has_role and target_role in user.roles:
-                    await user.remove_roles(target_role, reason="Синхронизация")
+            # Изменения собираем в один набор ролей и применяем одним запросом
+            roles = set(user.roles[1:])  # без @everyone
+            for role, has_role in changes:
+                if has_role:
+                    roles.add(role)
+                else:
+                    roles.discard(role)
+            await user.edit(roles=list(roles), reason="Синхронизация")
             
             return True
-        except:
+        except discord.Forbidden:
+            return False  # целевая роль выше роли бота, повторять бесполезно
+        except discord.HTTPException as e:
+            logger.error(f"Ошибка синхронизации ролей {user_id} на {guild.id}: {e}")
             return False
     
+    async def sync_member_targets(self, source_guild_id: int, user_id: int, role_ids=None):
+        """Синхронизирует участника на серверах, которые отслеживают роли с source_guild_id.
+        
+        role_ids - изменившиеся роли; если не заданы, подходит любая отслеживаемая роль.
+        """
+        targets = (await self.get_source_index()).get(source_guild_id, {})
+        for guild_id, source_role_ids in targets.items():
+            if role_ids is not None and source_role_ids.isdisjoint(role_ids):
+                continue
+            
+            guild = self.bot.get_guild(guild_id)
+            if guild:
+                await self.sync_user_roles(guild, user_id)
+    
+    async def sync_guild(self, guild: discord.Guild):
+        """Синхронизирует всех участников сервера и возвращает, сколько их было"""
+        members = [m for m in guild.members if not m.bot]
+        
+        # Отслеживаемые роли и серверы-источники разрешаем один раз на весь проход
+        sources = self.build_sources(guild, await self.get_tracked_roles(guild.id))
+        
+        # Параллельно, но не больше MONITOR_CONCURRENCY запросов одновременно; темп задаёт discord.py
+        semaphore = asyncio.Semaphore(MONITOR_CONCURRENCY)
+        await asyncio.gather(*(self._sync_with_limit(guild, member.id, semaphore, sources) for member in members), return_exceptions=True)
+        return len(members)
+    
+    async def _unban_one(self, banned, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            server = self.bot.get_guild(banned['server_id'])
+            if not server:
+                # Бота на сервере больше нет, снять бан уже не получится
+                return banned['server_id'], banned['user_id']
+            
+            try:
+                # Для разбана достаточно ID, fetch_user не нужен
+                await with_retry(server.unban, discord.Object(id=banned['user_id']), reason="Авторазбан")
+            except discord.NotFound:
+                pass  # бан уже снят вручную
+            except discord.Forbidden:
+                # Без права банить повтор не поможет, иначе запись навсегда останется в начале очереди
+                logger.warning(f"Нет прав на разбан {banned['user_id']} на сервере {banned['server_id']}")
+            return banned['server_id'], banned['user_id']
+    
     async def auto_unban_users(self):
         try:
-            users_to_unban = db.get_users_to_unban()
-            for banned in users_to_unban:
-                try:
-                    server = self.bot.get_guild(int(banned['server_id']))
-                    if server:
-                        user = await self.bot.fetch_user(int(banned['user_id']))
-                        await server.unban(user, reason="Авторазбан")
-                        db.unban_user(banned['server_id'], banned['user_id'])
-                except:
-                    pass
-        except:
-            pass
-    
-    @tasks.loop(seconds=3)
+            users_to_unban = await db_call(db.get_users_to_unban)
+            if not users_to_unban:
+                return
+            
+            # Разбаны идут параллельно, семафор ограничивает нагрузку на API
+            semaphore = asyncio.Semaphore(5)
+            results = await asyncio.gather(*(self._unban_one(banned, semaphore) for banned in users_to_unban), return_exceptions=True)
+            
+            # Отметку в БД делаем одним UPDATE для всех успешно разбаненных
+            unbanned = [result for result in results if isinstance(result, tuple)]
+            if unbanned:
+                await db_call(db.unban_users, unbanned)
+            
+            # Временные ошибки откладываем, иначе самые старые записи занимают всю пачку на каждом проходе
+            failed = [(banned['server_id'], banned['user_id']) for banned, result in zip(users_to_unban, results) if isinstance(result, Exception)]
+            if failed:
+                logger.error(f"Не удалось снять {len(failed)} банов, повтор через {UNBAN_RETRY_DELAY}")
+                await db_call(db.postpone_unbans, failed)
+        except Exception as e:
+            logger.error(f"Ошибка авторазбана: {e}")
+    
+    async def _sync_with_limit(self, guild: discord.Guild, user_id: int, semaphore: asyncio.Semaphore, sources=None):
+        async with semaphore:
+            return await self.sync_user_roles(guild, user_id, sources)
+    
+    async def _process_guild(self, guild: discord.Guild, semaphore: asyncio.Semaphore):
+        try:
+            tracked_roles = await self.get_tracked_roles(guild.id)
+            if not tracked_roles:
+                return
+            
+            members = [m for m in guild.members if not m.bot]
+            if not members:
+                return
+            
+            # Гильдии и роли находим один раз на тик, а не для каждого участника
+            sources = self.build_sources(guild, tracked_roles)
+            
+            # Обходим участников по кругу, а не только первых в списке
+            offset = self._monitor_offsets.get(guild.id, 0) % len(members)
+            batch = members[offset:offset + MONITOR_BATCH_SIZE]
+            if len(batch) < MONITOR_BATCH_SIZE:
+                batch += members[:min(offset, MONITOR_BATCH_SIZE - len(batch))]
+            self._monitor_offsets[guild.id] = offset + len(batch)
+            
+            await asyncio.gather(*(self._sync_with_limit(guild, member.id, semaphore, sources) for member in batch), return_exceptions=True)
+        except Exception as e:
+            logger.error(f"Ошибка мониторинга сервера {guild.id}: {e}")
+    
+    @tasks.loop(seconds=UNBAN_INTERVAL)
+    async def auto_unban_task(self):
+        await self.auto_unban_users()
+    
+    @tasks.loop(seconds=MONITOR_INTERVAL)
     async def monitor_roles_task(self):
         try:
-            await self.auto_unban_users()
-            for guild in self.bot.guilds:
-                try:
-                    members = [m for m in guild.members if not m.bot]
-                    for member in members[:3]:
-                        await self.sync_user_roles(guild, member.id)
-                        await asyncio.sleep(0.1)
-                except:
-                    pass
-        except:
-            pass
+            # Роли всех серверов одним запросом; _process_guild дальше берёт их из кэша
+            await self.refresh_tracked_roles()
+            
+            # Серверы обрабатываются параллельно, семафор общий на весь тик
+            semaphore = asyncio.Semaphore(MONITOR_CONCURRENCY)
+            async with asyncio.TaskGroup() as tg:
+                for guild in self.bot.guilds:
+                    tg.create_task(self._process_guild(guild, semaphore))
+        except Exception as e:
+            logger.error(f"Ошибка мониторинга ролей: {e}")
 
 role_monitor = RoleMonitor(bot)
 
@@ -407,14 +820,7 @@ role_monitor = RoleMonitor(bot)
 async def show_remove_role_menu(interaction: discord.Interaction):
     """Показывает меню выбора роли для удаления"""
     try:
-        guild = interaction.guild
-        server_data = db.get_or_create_server(str(guild.id), guild.name)
-        
-        if not server_data:
-            await interaction.followup.send("❌ Ошибка сервера", ephemeral=True)
-            return
-        
-        tracked_roles = db.get_tracked_roles(server_data['id'])
+        tracked_roles = await db_call(db.get_tracked_roles, interaction.guild.id)
         
         if not tracked_roles:
             embed = discord.Embed(
@@ -444,23 +850,22 @@ async def show_remove_role_menu(interaction: discord.Interaction):
 async def confirm_remove_role(interaction: discord.Interaction, role_id: int):
     """Показывает подтверждение удаления роли"""
     try:
-        role_data = db.get_tracked_role_by_id(role_id)
+        # Строка отслеживания и число использований целевой роли одним запросом
+        role_data = await db_call(db.get_tracked_role_with_usage, role_id)
         if not role_data:
             await interaction.followup.send("❌ Роль не найдена", ephemeral=True)
             return
         
         # Получаем информацию о роли
-        source_guild = bot.get_guild(int(role_data['source_server_id']))
+        source_guild = bot.get_guild(role_data['source_server_id'])
         source_role = None
         if source_guild:
-            source_role = source_guild.get_role(int(role_data['source_role_id']))
+            source_role = source_guild.get_role(role_data['source_role_id'])
         
+        # Целевая роль всегда создается на текущем сервере
         target_role = None
         if role_data['target_role_id']:
-            for guild in bot.guilds:
-                target_role = guild.get_role(int(role_data['target_role_id']))
-                if target_role:
-                    break
+            target_role = interaction.guild.get_role(role_data['target_role_id'])
         
         # Создаем embed с информацией
         embed = discord.Embed(
@@ -479,12 +884,9 @@ async def confirm_remove_role(interaction: discord.Interaction, role_id: int):
             embed.add_field(name="Целевая роль", value=target_role.mention, inline=False)
             
             # Проверяем, сколько пользователей имеют эту роль
-            members_with_role = len([m for m in target_role.members if not m.bot])
+            members_with_role = sum(1 for m in target_role.members if not m.bot)
             embed.add_field(name="Пользователей с ролью", value=str(members_with_role), inline=True)
-            
-            # Проверяем другие использования этой роли
-            usage_count = db.count_target_role_usage(role_data['target_role_id'])
-            embed.add_field(name="Используется в отслеживаниях", value=str(usage_count), inline=True)
+            embed.add_field(name="Используется в отслеживаниях", value=str(role_data['usage_count']), inline=True)
         else:
             embed.add_field(name="Целевая роль", value="Не назначена", inline=False)
         
@@ -494,57 +896,51 @@ async def confirm_remove_role(interaction: discord.Interaction, role_id: int):
             inline=False
         )
         
-        view = ConfirmRemoveView(role_id, role_data)
+        view = ConfirmRemoveView(role_id, role_data, target_role)
         await interaction.followup.send(embed=embed, view=view, ephemeral=True)
         
     except Exception as e:
         logger.error(f"Ошибка в confirm_remove_role: {e}")
         await interaction.followup.send("❌ Произошла ошибка", ephemeral=True)
 
-async def execute_remove_role(interaction: discord.Interaction, role_id: int, role_data: dict):
+async def execute_remove_role(interaction: discord.Interaction, role_id: int, role_data: dict, target_role=None):
     """Выполняет удаление роли"""
     try:
-        # Деактивируем роль в базе данных
-        db.deactivate_tracked_role(role_id)
+        # Деактивируем роль и проверяем другие отслеживания одной транзакцией
+        usage_count = await db_call(db.deactivate_tracked_role, role_id, role_data['target_role_id'] if target_role else None)
+        role_monitor.invalidate_tracked_roles(interaction.guild.id)
         
-        guild = interaction.guild
         embed = discord.Embed(title="✅ Роль удалена", color=discord.Color.green())
         
-        # Получаем информацию о целевой роли
-        if role_data['target_role_id']:
-            target_role = guild.get_role(int(role_data['target_role_id']))
-            
-            if target_role:
-                # Проверяем, используется ли эта роль в других отслеживаниях
-                usage_count = db.count_target_role_usage(role_data['target_role_id'])
+        # Целевая роль уже найдена на шаге подтверждения
+        if target_role:
+            if usage_count == 0:
+                # Роль больше не используется, можно удалить
+                members_count = len([m for m in target_role.members if not m.bot])
                 
-                if usage_count == 0:
-                    # Роль больше не используется, можно удалить
-                    members_count = len([m for m in target_role.members if not m.bot])
-                    
-                    if members_count > 0:
-                        embed.add_field(
-                            name="💡 Рекомендация", 
-                            value=f"Целевая роль {target_role.mention} больше не используется в отслеживаниях, но назначена **{members_count}** пользователям. Вы можете удалить её вручную.",
-                            inline=False
-                        )
-                    else:
-                        embed.add_field(
-                            name="💡 Информация", 
-                            value=f"Целевая роль {target_role.mention} больше не используется. Вы можете безопасно удалить её.",
-                            inline=False
-                        )
+                if members_count > 0:
+                    embed.add_field(
+                        name="💡 Рекомендация", 
+                        value=f"Целевая роль {target_role.mention} больше не используется в отслеживаниях, но назначена **{members_count}** пользователям. Вы можете удалить её вручную.",
+                        inline=False
+                    )
                 else:
                     embed.add_field(
-                        name="ℹ️ Информация", 
-                        value=f"Целевая роль {target_role.mention} используется в других отслеживаниях ({usage_count}).",
+                        name="💡 Информация", 
+                        value=f"Целевая роль {target_role.mention} больше не используется. Вы можете безопасно удалить её.",
                         inline=False
                     )
+            else:
+                embed.add_field(
+                    name="ℹ️ Информация", 
+                    value=f"Целевая роль {target_role.mention} используется в других отслеживаниях ({usage_count}).",
+                    inline=False
+                )
         
         # Получаем информацию об исходной роли
-        source_guild = bot.get_guild(int(role_data['source_server_id']))
+        source_guild = bot.get_guild(role_data['source_server_id'])
         if source_guild:
-            source_role = source_guild.get_role(int(role_data['source_role_id']))
+            source_role = source_guild.get_role(role_data['source_role_id'])
             if source_role:
                 embed.add_field(
                     name="Удаленная роль", 
@@ -552,11 +948,14 @@ async def execute_remove_role(interaction: discord.Interaction, role_id: int, ro
                     inline=False
                 )
         
-        await interaction.followup.send(embed=embed, ephemeral=True)
+        await interaction.edit_original_response(content=None, embed=embed, view=None)
         
     except Exception as e:
         logger.error(f"Ошибка в execute_remove_role: {e}")
-        await interaction.followup.send("❌ Произошла ошибка при удалении роли", ephemeral=True)
+        try:
+            await interaction.edit_original_response(content="❌ Произошла ошибка при удалении роли", embed=None, view=None)
+        except discord.HTTPException:
+            pass  # сообщение подтверждения уже недоступно, повторять ответ бесполезно
 
 async def remove_role_by_id(interaction: discord.Interaction, role_id: str):
     """Удаляет роль по ID (для модального окна)"""
@@ -565,15 +964,8 @@ async def remove_role_by_id(interaction: discord.Interaction, role_id: str):
             await interaction.followup.send("❌ ID роли должен быть числом", ephemeral=True)
             return
         
-        guild = interaction.guild
-        server_data = db.get_or_create_server(str(guild.id), guild.name)
-        
-        if not server_data:
-            await interaction.followup.send("❌ Ошибка сервера", ephemeral=True)
-            return
-        
         # Ищем роль по source_role_id
-        role_data = db.get_tracked_role_by_source_id(server_data['id'], role_id)
+        role_data = await db_call(db.get_tracked_role_by_source_id, interaction.guild.id, int(role_id))
         
         if not role_data:
             await interaction.followup.send("❌ Роль с таким ID не найдена", ephemeral=True)
@@ -592,51 +984,47 @@ async def setup_server(interaction: discord.Interaction):
         await interaction.followup.send("🔄 Начинаю настройку...", ephemeral=True)
         guild = interaction.guild
         
-        if not db.conn:
+        if not db.connected:
             await interaction.edit_original_response(content="❌ Ошибка базы данных")
             return
         
-        db.create_tables()
-        server_data = db.get_or_create_server(str(guild.id), guild.name)
+        await db_call(db.get_or_create_server, guild.id, guild.name)
         
-        # Создаем категории
+        # Категории создаем по очереди: так они встают в конец списка сервера, MAIN перед HIGH
         main_category = await guild.create_category(name="MAIN")
         high_category = await guild.create_category(name="HIGH")
         
         base_overwrites = {
-            guild.default_role: discord.PermissionOverwrite(view_channel=False)
+            guild.default_role: HIDDEN_OVERWRITE
         }
         
-        # Создаем каналы
-        news = await main_category.create_text_channel(name="news", overwrites=base_overwrites)
-        flood = await main_category.create_text_channel(name="flood", overwrites=base_overwrites)
-        tags = await main_category.create_text_channel(name="tags", overwrites=base_overwrites)
-        media = await main_category.create_text_channel(name="media", overwrites=base_overwrites)
-        logs = await high_category.create_text_channel(name="logs", overwrites=base_overwrites)
-        high_flood = await high_category.create_text_channel(name="high-flood", overwrites=base_overwrites)
-        
-        voice_channels = []
-        for i in range(1, 5):
-            voice = await main_category.create_voice_channel(name=f"voice {i}", overwrites=base_overwrites)
-            voice_channels.append(voice)
-        
-        high_voice = await high_category.create_voice_channel(name="high-voice", overwrites=base_overwrites)
+        # Создаем каналы: они не зависят друг от друга, поэтому одним gather
+        news, flood, tags, media, logs, high_flood, high_voice, *voice_channels = await asyncio.gather(
+            main_category.create_text_channel(name="news", overwrites=base_overwrites, position=0),
+            main_category.create_text_channel(name="flood", overwrites=base_overwrites, position=1),
+            main_category.create_text_channel(name="tags", overwrites=base_overwrites, position=2),
+            main_category.create_text_channel(name="media", overwrites=base_overwrites, position=3),
+            high_category.create_text_channel(name="logs", overwrites=base_overwrites, position=0),
+            high_category.create_text_channel(name="high-flood", overwrites=base_overwrites, position=1),
+            high_category.create_voice_channel(name="high-voice", overwrites=base_overwrites, position=0),
+            *(main_category.create_voice_channel(name=f"voice {i}", overwrites=base_overwrites, position=i - 1) for i in range(1, 5))
+        )
         
         # Сохраняем настройки
         settings = {
-            'news_channel_id': str(news.id),
-            'flood_channel_id': str(flood.id),
-            'tags_channel_id': str(tags.id),
-            'media_channel_id': str(media.id),
-            'logs_channel_id': str(logs.id),
-            'high_flood_channel_id': str(high_flood.id),
-            'voice_channel_ids': [str(vc.id) for vc in voice_channels],
-            'high_voice_channel_id': str(high_voice.id),
-            'main_category_id': str(main_category.id),
-            'high_category_id': str(high_category.id)
+            'news_channel_id': news.id,
+            'flood_channel_id': flood.id,
+            'tags_channel_id': tags.id,
+            'media_channel_id': media.id,
+            'logs_channel_id': logs.id,
+            'high_flood_channel_id': high_flood.id,
+            'voice_channel_ids': [vc.id for vc in voice_channels],
+            'high_voice_channel_id': high_voice.id,
+            'main_category_id': main_category.id,
+            'high_category_id': high_category.id
         }
         
-        db.save_settings(server_data['id'], settings)
+        await db_call(db.save_settings, guild.id, settings)
         
         embed = discord.Embed(title="✅ Сервер настроен", color=discord.Color.green())
         embed.add_field(name="📁 Категория MAIN", value=f"{news.mention} {flood.mention} {tags.mention} {media.mention}", inline=False)
@@ -656,33 +1044,35 @@ async def add_role(interaction: discord.Interaction, source_server_id: str, sour
             await interaction.edit_original_response(content="❌ ID должны быть числами")
             return
         
-        source_guild = bot.get_guild(int(source_server_id))
+        source_server_id = int(source_server_id)
+        source_role_id = int(source_role_id)
+        
+        source_guild = bot.get_guild(source_server_id)
         if not source_guild:
             await interaction.edit_original_response(content="❌ Сервер не найден")
             return
         
-        source_role = source_guild.get_role(int(source_role_id))
+        source_role = source_guild.get_role(source_role_id)
         if not source_role:
             await interaction.edit_original_response(content="❌ Роль не найдена")
             return
         
-        server_data = db.get_or_create_server(str(guild.id), guild.name)
-        if not server_data:
+        if not await db_call(db.get_or_create_server, guild.id, guild.name):
             await interaction.edit_original_response(content="❌ Ошибка сервера")
             return
         
-        # Проверяем существующие роли
-        tracked_roles = db.get_tracked_roles(server_data['id'])
+        # Обе проверки ниже касаются только этого сервера-источника, остальные строки не загружаем
+        tracked_roles = await db_call(db.get_tracked_roles_for_source, guild.id, source_server_id)
         for role in tracked_roles:
-            if role['source_server_id'] == source_server_id and role['source_role_id'] == source_role_id:
+            if role['source_role_id'] == source_role_id:
                 await interaction.edit_original_response(content="❌ Роль уже отслеживается")
                 return
         
         # Ищем существующую целевую роль
         existing_target_role = None
         for role in tracked_roles:
-            if role['source_server_id'] == source_server_id and role['target_role_id']:
-                target_role = guild.get_role(int(role['target_role_id']))
+            if role['target_role_id']:
+                target_role = guild.get_role(role['target_role_id'])
                 if target_role:
                     existing_target_role = target_role
                     break
@@ -694,9 +1084,8 @@ async def add_role(interaction: discord.Interaction, source_server_id: str, sour
             target_role = await guild.create_role(name=role_name, color=discord.Color.random())
         
         # Сохраняем в БД
-        tracked_id = db.add_tracked_role(server_data['id'], source_server_id, source_role_id)
-        if tracked_id:
-            db.update_target_role(tracked_id, str(target_role.id))
+        await db_call(db.add_tracked_role, guild.id, source_server_id, source_role_id, target_role.id)
+        role_monitor.invalidate_tracked_roles(guild.id)
         
         embed = discord.Embed(title="✅ Роль добавлена", color=discord.Color.green())
         embed.add_field(name="Сервер", value=source_guild.name, inline=True)
@@ -709,41 +1098,39 @@ async def add_role(interaction: discord.Interaction, source_server_id: str, sour
 
 async def list_roles(interaction: discord.Interaction):
     try:
-        server_data = db.get_or_create_server(str(interaction.guild.id), interaction.guild.name)
-        if not server_data:
-            await interaction.followup.send("❌ Ошибка", ephemeral=True)
-            return
-        
-        tracked_roles = db.get_tracked_roles(server_data['id'])
+        tracked_roles = await db_call(db.get_tracked_roles, interaction.guild.id)
         
         if not tracked_roles:
             await interaction.followup.send("ℹ️ Нет активных отслеживаемых ролей", ephemeral=True)
             return
         
-        embed = discord.Embed(title="📋 Отслеживаемые роли", color=discord.Color.purple())
+        # Серверов-источников обычно меньше, чем отслеживаний: каждый находим один раз
+        source_guilds = {server_id: bot.get_guild(server_id) for server_id in {role['source_server_id'] for role in tracked_roles}}
         
+        lines = []
         for role in tracked_roles:
             # Получаем информацию о роли
-            source_guild = bot.get_guild(int(role['source_server_id']))
+            source_guild = source_guilds[role['source_server_id']]
             source_role = None
             if source_guild:
-                source_role = source_guild.get_role(int(role['source_role_id']))
+                source_role = source_guild.get_role(role['source_role_id'])
             
-            target_role = interaction.guild.get_role(int(role['target_role_id'])) if role['target_role_id'] else None
+            target_role = interaction.guild.get_role(role['target_role_id']) if role['target_role_id'] else None
             
             if source_role and target_role:
-                field_value = f"**{source_role.name}** → {target_role.mention}"
-                if source_guild:
-                    field_value += f"\nСервер: {source_guild.name}"
+                value = f"**{source_role.name}** → {target_role.mention}\nСервер: {source_guild.name}"
             else:
-                field_value = f"ID роли: {role['source_role_id']}"
+                value = f"ID роли: {role['source_role_id']}"
                 if role['target_role_id']:
-                    field_value += f" → Роль ID: {role['target_role_id']}"
+                    value = f"{value} → Роль ID: {role['target_role_id']}"
             
-            embed.add_field(name=f"🔗 Отслеживание #{role['id']}", value=field_value, inline=False)
+            lines.append(f"🔗 **Отслеживание #{role['id']}**\n{value}")
         
-        embed.set_footer(text=f"Всего ролей: {len(tracked_roles)}")
-        await interaction.followup.send(embed=embed, ephemeral=True)
+        # В embed помещается не больше 25 полей, поэтому список разбиваем на страницы-описания
+        for start in range(0, len(lines), ROLES_PER_PAGE):
+            embed = discord.Embed(title="📋 Отслеживаемые роли", description="\n\n".join(lines[start:start + ROLES_PER_PAGE]), color=discord.Color.purple())
+            embed.set_footer(text=f"Всего ролей: {len(tracked_roles)}")
+            await interaction.followup.send(embed=embed, ephemeral=True)
     except Exception as e:
         logger.error(f"Ошибка в list_roles: {e}")
         await interaction.followup.send("❌ Ошибка при загрузке списка ролей", ephemeral=True)
@@ -751,15 +1138,7 @@ async def list_roles(interaction: discord.Interaction):
 async def sync_all(interaction: discord.Interaction):
     try:
         await interaction.followup.send("🔄 Начинаю синхронизацию...", ephemeral=True)
-        guild = interaction.guild
-        members = [m for m in guild.members if not m.bot]
-        
-        processed = 0
-        for member in members:
-            await role_monitor.sync_user_roles(guild, member.id)
-            processed += 1
-            if processed % 10 == 0:
-                await asyncio.sleep(0.1)
+        processed = await role_monitor.sync_guild(interaction.guild)
         
         embed = discord.Embed(title="✅ Синхронизация завершена", color=discord.Color.green())
         embed.add_field(name="Обработано пользователей", value=str(processed), inline=True)
@@ -771,20 +1150,20 @@ async def sync_all(interaction: discord.Interaction):
 async def stats(interaction: discord.Interaction):
     try:
         guild = interaction.guild
-        server_data = db.get_or_create_server(str(guild.id), guild.name)
         
         embed = discord.Embed(title=f"📊 Статистика {guild.name}", color=discord.Color.blue())
         embed.add_field(name="👥 Участники", value=str(guild.member_count), inline=True)
         embed.add_field(name="💬 Каналы", value=str(len(guild.channels)), inline=True)
         embed.add_field(name="👑 Роли сервера", value=str(len(guild.roles)), inline=True)
         
-        if server_data:
-            tracked_roles = db.get_tracked_roles(server_data['id'])
-            banned = db.get_banned_users(server_data['id'])
-            settings = db.get_settings(server_data['id'])
+        if db.connected:
+            # Для статистики нужны только количества: роли берём из кэша монитора, баны считает БД
+            tracked_roles = await role_monitor.get_tracked_roles(guild.id)
+            banned_count = await db_call(db.count_banned_users, guild.id)
+            settings = await db_call(db.get_settings, guild.id)
             
             embed.add_field(name="📡 Отслеживаемые роли", value=str(len(tracked_roles)), inline=True)
-            embed.add_field(name="🔨 Активные баны", value=str(len(banned)), inline=True)
+            embed.add_field(name="🔨 Активные баны", value=str(banned_count), inline=True)
             
             if settings:
                 has_news = "✅" if settings.get('news_channel_id') else "❌"
@@ -798,16 +1177,18 @@ async def stats(interaction: discord.Interaction):
 
 async def unban(interaction: discord.Interaction, user_id: str):
     try:
-        if not user_id.isdigit():
+        # int() принял бы и "1_000", "+5" и полноширинные цифры, поэтому пропускаем только ASCII-цифры
+        user_id = user_id.strip()
+        uid = int(user_id) if user_id.isascii() and user_id.isdigit() else 0
+        if uid <= 0:
             await interaction.edit_original_response(content="❌ ID должен быть числом")
             return
         
-        user = await bot.fetch_user(int(user_id))
-        await interaction.guild.unban(user, reason="Разбан")
+        # Сначала кэш пользователей бота, REST-запрос только для незнакомых ID
+        user = bot.get_user(uid) or await bot.fetch_user(uid)
+        await with_retry(interaction.guild.unban, user, reason="Разбан")
         
-        server_data = db.get_or_create_server(str(interaction.guild.id), interaction.guild.name)
-        if server_data:
-            db.unban_user(server_data['id'], user_id)
+        await db_call(db.unban_user, interaction.guild.id, user.id)
         
         embed = discord.Embed(title="✅ Пользователь разблокирован", color=discord.Color.green())
         embed.add_field(name="Пользователь", value=f"{user.name} ({user.id})", inline=False)
@@ -823,7 +1204,6 @@ async def unban(interaction: discord.Interaction, user_id: str):
 @app_commands.checks.has_permissions(administrator=True)
 async def souz_command(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=False)
-    await asyncio.sleep(0.1)
     
     embed = discord.Embed(
         title="🤝 ДОБРО ПОЖАЛОВАТЬ В СОЮЗНЫЙ БОТ!",
@@ -851,22 +1231,62 @@ async def on_ready():
         print('✅ Команды синхронизированы')
     except Exception as e:
         print(f'⚠️ Ошибка синхронизации команд: {e}')
-    role_monitor.monitor_roles_task.start()
+    await db_call(db.preload_servers, [guild.id for guild in bot.guilds])
+    # on_ready повторяется после переподключений, а задачу можно запустить только один раз
+    if not role_monitor.monitor_roles_task.is_running():
+        # Панель регистрируется один раз: кнопки старых сообщений /souz работают и после перезапуска
+        bot.add_view(ControlPanelView())
+        role_monitor.monitor_roles_task.start()
+        role_monitor.auto_unban_task.start()
     print('✅ Мониторинг ролей запущен')
 
 @bot.event
 async def on_guild_join(guild):
     print(f'✅ Бот добавлен на сервер: {guild.name} (ID: {guild.id})')
     
-    # Автоматически создаем таблицы для нового сервера
-    db.get_or_create_server(str(guild.id), guild.name)
-    db.create_tables()
+    # Таблицы создаются один раз при запуске, здесь только регистрируем сервер
+    await db_call(db.get_or_create_server, guild.id, guild.name)
 
 @bot.event
 async def on_guild_remove(guild):
     print(f'❌ Бот удален с сервера: {guild.name} (ID: {guild.id})')
+    db.forget_server(guild.id)
+    role_monitor.invalidate_tracked_roles(guild.id)
+
+@bot.event
+async def on_member_update(before, after):
+    # Роли изменились на сервере-источнике - обновляем только затронутые целевые серверы
+    changed = {role.id for role in set(before.roles) ^ set(after.roles)}
+    if changed:
+        await role_monitor.sync_member_targets(after.guild.id, after.id, changed)
+
+@bot.event
+async def on_member_join(member):
+    if not member.bot:
+        await role_monitor.sync_user_roles(member.guild, member.id)
+
+@bot.event
+async def on_member_remove(member):
+    # Ушедший с сервера-источника теряет роли, выданные по нему
+    await role_monitor.sync_member_targets(member.guild.id, member.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    # Удалённая роль-источник пропадает у всех сразу, отдельных on_member_update на это не будет
+    targets = (await role_monitor.get_source_index()).get(role.guild.id, {})
+    for guild_id, source_role_ids in targets.items():
+        guild = bot.get_guild(guild_id)
+        if guild and role.id in source_role_ids:
+            await role_monitor.sync_guild(guild)
 
 if __name__ == "__main__":
+    # uvloop быстрее стандартного цикла событий; на Windows его нет, там работаем без него
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    
     try:
         bot.run(TOKEN)
     except KeyboardInterrupt: